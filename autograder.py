@@ -1,10 +1,18 @@
 import os
+import csv
+import io
 import sys
 import glob
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
 import importlib.util
 from pathlib import Path
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text, inspect
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.engine.url import make_url
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.sql_database import SQLDatabase
@@ -17,29 +25,272 @@ SOLUTION_QUERIES_DIR = "/opt/pm883-1/dongkwang/ta/nl2sql/solution_queries"
 RESULTS_DIR = "/opt/pm883-1/dongkwang/ta/nl2sql/autograder_results"
 NL_QUERIES_VAR_NAME = "nlqueries"
 TEST_DATABASE_NAME = "testnl2sql"
+LLM_MODEL_NAME = "gemini-2.5-flash"
+LLM_CACHE_PATH = "./llm_cache.sqlite"
+# Least-recently-used entries beyond this count are evicted when the cache is
+# closed, so the SQLite file stays bounded across semesters of runs.
+LLM_CACHE_MAX_ENTRIES = 10_000
+# Rows are streamed from the server in batches of this size instead of
+# materialized all at once, so a runaway generated query cannot exhaust memory.
+STREAM_BATCH_SIZE = 1024
+MAX_RESULT_ROWS = 100_000
+# Maximum number of agent invocations in flight at once. The LLM calls are
+# network-bound and independent, so overlapping them is where the speedup
+# comes from; the cap keeps us from hammering the Gemini QPS limit.
+MAX_CONCURRENT_QUERIES = 8
+# Size of the async connection pool, and the cap on concurrent generated-query
+# executions. Keeping them equal means a burst of cache hits queues on this
+# semaphore instead of timing out on pool checkout.
+DB_POOL_SIZE = 32
 
-def execute_sql(engine, sql_query: str) -> tuple[str, str | None]:
-    """Executes a SQL query and returns the result as a formatted string and a potential error."""
+async def execute_sql(connection, sql_query: str) -> tuple[str, str | None]:
+    """Executes a SQL query on a shared connection and returns the result as a formatted string and a potential error."""
     if not sql_query or sql_query == "N/A":
         return "(No query to execute)", None
     try:
-        with engine.connect() as connection:
-            result = connection.execute(text(sql_query))
-            rows = result.fetchall()
-            if not rows:
-                return "(No rows returned)", None
-            
-            headers = result.keys()
-            # Format into a simple table
-            header_str = " | ".join(map(str, headers))
-            separator = "-" * len(header_str)
-            row_strs = [" | ".join(map(str, row)) for row in rows]
-            
-            return f"\n{header_str}\n{separator}\n" + "\n".join(row_strs), None
+        result = await connection.stream(text(sql_query))
+
+        headers = result.keys()
+        # Format into a simple table, one server-side batch at a time.
+        # csv.writer runs the per-cell str() and separator insertion in C,
+        # which is markedly faster than a Python join per row. QUOTE_MINIMAL
+        # is set deliberately: a cell containing the delimiter, a quote, or a
+        # newline gets quote-wrapped, and the header goes through the same
+        # writer so it renders exactly like the data rows.
+        buf = io.StringIO()
+        buf.write("\n")
+        writer = csv.writer(
+            buf, delimiter="|", quotechar='"',
+            quoting=csv.QUOTE_MINIMAL, lineterminator="\n",
+        )
+        writer.writerow(list(headers))
+        header_len = buf.tell() - 2  # minus the leading and trailing newline
+        buf.write("-" * header_len + "\n")
+
+        row_count = 0
+        async for partition in result.partitions(STREAM_BATCH_SIZE):
+            writer.writerows(partition)
+            row_count += len(partition)
+            if row_count >= MAX_RESULT_ROWS:
+                buf.write(f"... (output truncated at {MAX_RESULT_ROWS} rows)\n")
+                break
+        await result.close()
+
+        if row_count == 0:
+            return "(No rows returned)", None
+        return buf.getvalue().rstrip("\n"), None
     except Exception as e:
+        # Reset the shared connection so the failed statement does not poison
+        # the transaction for the next query.
+        await connection.rollback()
         return f"ERROR: {e}", str(e)
 
-def main():
+# Extracted query lists are cached here keyed by (path, mtime) so re-runs skip
+# re-parsing and re-executing unchanged submission files.
+QUERY_CACHE_DIR = Path.home() / ".cache" / "grader"
+
+def load_nl_queries(query_file_path: str) -> list[str] | None:
+    """Imports a submission module and extracts its NL query list."""
+    try:
+        spec = importlib.util.spec_from_file_location("nl_queries_module", query_file_path)
+        queries_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(queries_module)
+        return getattr(queries_module, NL_QUERIES_VAR_NAME)
+    except (AttributeError, FileNotFoundError, SyntaxError) as e:
+        print(f"  - ERROR: Could not load '{NL_QUERIES_VAR_NAME}' from {query_file_path}. Error: {e}. Skipping.")
+        return None
+
+def load_cached_queries(query_file_path: str) -> list[str] | None:
+    """Loads NL queries, serving unchanged files from an on-disk cache."""
+    file_path = Path(query_file_path)
+    cache_file = None
+    try:
+        stat = file_path.stat()
+        cache_key = hashlib.sha256(f"{file_path.resolve()}|{stat.st_mtime_ns}".encode()).hexdigest()
+        cache_file = QUERY_CACHE_DIR / f"{cache_key}.json"
+        if cache_file.exists():
+            return json.loads(cache_file.read_text())
+    except (OSError, json.JSONDecodeError):
+        pass
+
+    queries = load_nl_queries(query_file_path)
+    if queries is not None and cache_file is not None:
+        try:
+            QUERY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            cache_file.write_text(json.dumps(queries))
+        except (OSError, TypeError) as e:
+            print(f"  - Warning: could not write query cache: {e}")
+    return queries
+
+class LLMCache:
+    """Persistent memoization of agent results, keyed by (model, schema, NL query).
+
+    Many submissions share identical NL prompts against the same schema, so the
+    generated SQL can be served from disk instead of re-invoking Gemini. An
+    in-process dict acts as an L1 on top of the SQLite file so repeated hits
+    within one run skip the disk lookup too.
+    """
+
+    def __init__(self, path: str, schema_fingerprint: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache "
+            "(key TEXT PRIMARY KEY, generated_sql TEXT, last_used REAL)"
+        )
+        try:
+            # Migrate cache files created before the last_used column existed.
+            self._conn.execute("ALTER TABLE llm_cache ADD COLUMN last_used REAL")
+        except sqlite3.OperationalError:
+            pass
+        self._conn.commit()
+        self._fingerprint = schema_fingerprint
+        self._l1: dict[str, str] = {}
+
+    def _key(self, nl_query: str) -> str:
+        return hashlib.sha256(f"{LLM_MODEL_NAME}|{self._fingerprint}|{nl_query}".encode()).hexdigest()
+
+    def get(self, nl_query: str) -> str | None:
+        key = self._key(nl_query)
+        if key in self._l1:
+            return self._l1[key]
+        row = self._conn.execute("SELECT generated_sql FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._l1[key] = row[0]
+            self._conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+        return None
+
+    def put(self, nl_query: str, generated_sql: str) -> None:
+        key = self._key(nl_query)
+        self._l1[key] = generated_sql
+        self._conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, generated_sql, last_used) VALUES (?, ?, ?)",
+            (key, generated_sql, time.time()),
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        # LRU eviction: keep the most recently used entries, drop the rest.
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key NOT IN "
+            "(SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT ?)",
+            (LLM_CACHE_MAX_ENTRIES,),
+        )
+        self._conn.commit()
+        self._conn.close()
+
+async def compute_schema_fingerprint(engine) -> str:
+    """Hashes the table/column layout of the test database for cache keying."""
+    def _collect(sync_conn):
+        inspector = inspect(sync_conn)
+        parts = []
+        for table in sorted(inspector.get_table_names()):
+            columns = sorted(col["name"] for col in inspector.get_columns(table))
+            parts.append(f"{table}({','.join(columns)})")
+        return ";".join(parts)
+
+    async with engine.connect() as connection:
+        schema_text = await connection.run_sync(_collect)
+    return hashlib.sha256(schema_text.encode()).hexdigest()
+
+async def cached_invoke(agent_executor, llm_cache, semaphore, nl_query: str) -> str:
+    """Returns the generated SQL for an NL query, consulting the cache first."""
+    cached_sql = llm_cache.get(nl_query)
+    if cached_sql is not None:
+        return cached_sql
+
+    generated_sql = "N/A"
+    async with semaphore:
+        response = await agent_executor.ainvoke({"input": nl_query})
+    if response.get("intermediate_steps"):
+        for step in response["intermediate_steps"]:
+            if step[0].tool == 'sql_db_query':
+                generated_sql = step[0].tool_input
+                break
+    # Only successful agent runs are worth remembering: caching an "N/A"
+    # would pin a flaky response onto this prompt for every future run.
+    if generated_sql != "N/A":
+        llm_cache.put(nl_query, generated_sql)
+    return generated_sql
+
+async def execute_golden_queries(engine) -> tuple[dict[int, str], dict[int, tuple[str, str | None]]]:
+    """Reads and executes every golden query once, keyed by query number.
+
+    Both the SQL text and its result are identical for every submission, so
+    re-reading/re-executing them inside the per-submission loop would cost
+    S x Q redundant NFS reads and Postgres round-trips.
+    """
+    # os.scandir does one getdents pass instead of a stat per fnmatch entry,
+    # which matters on the shared filesystem these directories live on.
+    try:
+        with os.scandir(SOLUTION_QUERIES_DIR) as it:
+            solution_files = sorted(
+                e.path for e in it
+                if e.is_file() and e.name.startswith("query-") and e.name.endswith(".sql")
+            )
+    except FileNotFoundError:
+        solution_files = []
+
+    golden_sqls = {}
+    golden_results = {}
+    async with engine.connect() as connection:
+        for sol_file in solution_files:
+            try:
+                query_num = int(Path(sol_file).stem.split('-')[1])
+            except (ValueError, IndexError):
+                print(f"Warning: Could not parse query number from solution file: {sol_file}")
+                continue
+            golden_sqls[query_num] = Path(sol_file).read_text()
+            golden_results[query_num] = await execute_sql(connection, golden_sqls[query_num])
+    return golden_sqls, golden_results
+
+async def resolve_prompt(engine, agent_executor, llm_cache, semaphore, db_semaphore, nl_query) -> tuple[str, str]:
+    """Generates SQL for one distinct NL prompt and executes it once.
+
+    Both the generated SQL and its result are deterministic per prompt (modulo
+    model temperature), so every submission that produced this prompt can share
+    the outcome.
+    """
+    try:
+        generated_sql = await cached_invoke(agent_executor, llm_cache, semaphore, nl_query)
+    except Exception as e:
+        generated_sql = f"Agent execution failed: {e}"
+
+    # Cache hits skip the LLM semaphore entirely, so on a warm cache every
+    # prompt arrives here at once; the DB semaphore keeps concurrent
+    # executions within the pool instead of timing out on checkout.
+    async with db_semaphore:
+        async with engine.connect() as connection:
+            gen_result, _ = await execute_sql(connection, generated_sql)
+    return generated_sql, gen_result
+
+def write_result(output_dir, submission_id, i, nl_query, generated_sql, gen_result, golden_sqls, golden_results):
+    """Writes the per-query report file for one (submission, query) pair."""
+    output_content = [f"--- Autograder Result for Submission {submission_id}, Query {i} ---\n"]
+    output_content.append(f"[Natural Language Query]:\n{nl_query}\n")
+    output_content.append(f"[Generated SQL]:\n{generated_sql}\n")
+    output_content.append(f"[Result of Generated SQL]:{gen_result}\n")
+
+    golden_sql = golden_sqls.get(i, "N/A")
+    golden_result = "(Golden query file not found)"
+    if golden_sql != "N/A":
+        golden_result, _ = golden_results.get(i, ("(Golden query file not found)", None))
+
+    output_content.append(f"--- Golden Solution ---\n")
+    output_content.append(f"[Golden SQL from query-{i}.sql]:\n{golden_sql}\n")
+    output_content.append(f"[Result of Golden SQL]:{golden_result}\n")
+
+    # One pre-encoded buffer and one write() per file; on the shared
+    # filesystem the syscall count dominates small-file writes.
+    buf = bytearray()
+    for part in output_content:
+        buf += part.encode()
+        buf += b"\n"
+    output_file_path = output_dir / f"result-{i}.txt"
+    output_file_path.write_bytes(bytes(buf))
+
+async def main():
     """Main function to run the autograder."""
     # 1. Setup
     print("--- Starting Autograder ---")
@@ -52,27 +303,42 @@ def main():
     base_db_url = os.getenv("DATABASE_URL")
     db_url_obj = make_url(base_db_url)
     test_db_url = db_url_obj.set(database=TEST_DATABASE_NAME)
-    
+
     try:
-        engine = create_engine(str(test_db_url))
-        with engine.connect() as conn:
+        # asyncpg driver so concurrent query executions don't block the loop.
+        # The pool is sized to the grading fanout so concurrent tasks never
+        # starve waiting for a connection; pre-ping revives stale ones.
+        engine = create_async_engine(
+            str(test_db_url.set(drivername="postgresql+asyncpg")),
+            pool_size=DB_POOL_SIZE,
+            max_overflow=0,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+        )
+        async with engine.connect() as conn:
             pass
         print(f"Successfully connected to test database: {TEST_DATABASE_NAME}")
     except Exception as e:
         print(f"FATAL: Could not connect to test database '{TEST_DATABASE_NAME}'. Error: {e}", file=sys.stderr)
         sys.exit(1)
 
+    # The agent still talks to the DB through its own synchronous connection;
+    # only the grading harness uses the async engine.
+    sync_engine_url = str(test_db_url)
+
     # LLM and Rate Limiter setup, mirroring main.py
     rate_limiter = InMemoryRateLimiter(
         requests_per_second=0.15,
         check_every_n_seconds=0.5,
         max_bucket_size=3,
     )
-    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.5, max_retries=2, rate_limiter=rate_limiter)
+    # The model name must come from LLM_MODEL_NAME: it keys the persistent
+    # cache, and a literal here could drift and serve another model's SQL.
+    llm = ChatGoogleGenerativeAI(model=LLM_MODEL_NAME, temperature=0.5, max_retries=2, rate_limiter=rate_limiter)
     print("Gemini LLM initialized successfully (matching main.py setup).")
 
-    db_for_agent = SQLDatabase(engine=engine)
-    
+    db_for_agent = SQLDatabase.from_uri(sync_engine_url)
+
     # Agent setup, mirroring main.py but without memory for independent queries
     agent_executor = create_sql_agent(
         llm=llm,
@@ -83,19 +349,45 @@ def main():
         return_intermediate_steps=True
     )
 
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+    db_semaphore = asyncio.Semaphore(DB_POOL_SIZE)
+
+    # The schema fingerprint pass and the golden-query pre-execution are
+    # independent DB work, so they run concurrently on separate connections.
+    schema_fingerprint, (golden_sqls, golden_results) = await asyncio.gather(
+        compute_schema_fingerprint(engine),
+        execute_golden_queries(engine),
+    )
+
+    # Persistent LLM cache: repeated NL prompts across submissions are served
+    # from disk instead of spending another Gemini call.
+    llm_cache = LLMCache(LLM_CACHE_PATH, schema_fingerprint)
+    print(f"LLM cache ready at {LLM_CACHE_PATH} (schema {schema_fingerprint[:12]}...).")
+    print(f"Pre-executed {len(golden_results)} golden queries.")
+
     Path(RESULTS_DIR).mkdir(exist_ok=True)
 
     # 2. Find and process submissions
-    submission_dirs = glob.glob(f"{SUBMISSIONS_DIR}/submission_*/")
+    try:
+        with os.scandir(SUBMISSIONS_DIR) as it:
+            submission_dirs = sorted(
+                e.path for e in it if e.is_dir() and e.name.startswith("submission_")
+            )
+    except FileNotFoundError:
+        submission_dirs = []
     if not submission_dirs:
         print(f"Warning: No submission directories found in {SUBMISSIONS_DIR}")
         return
 
     print(f"Found {len(submission_dirs)} submissions to process.")
 
-    for sub_dir in sorted(submission_dirs):
+    # 3. First pass: collect every occurrence of each distinct NL prompt.
+    # Submissions sharing a prompt template produce identical prompts, so the
+    # LLM only needs to see each distinct one once.
+    prompts: dict[str, list[tuple[str, Path, int]]] = {}
+    for sub_dir in submission_dirs:
         submission_id = Path(sub_dir).name.split('_')[-1]
-        print(f"\nProcessing submission: {submission_id}")
+        print(f"\nCollecting submission: {submission_id}")
 
         output_dir = Path(RESULTS_DIR) / submission_id
         output_dir.mkdir(exist_ok=True)
@@ -104,56 +396,43 @@ def main():
         if not query_files:
             print(f"  - ERROR: No '*queries.py' file found in {sub_dir}. Skipping.")
             continue
-        
+
         query_file_path = query_files[0]
 
-        try:
-            spec = importlib.util.spec_from_file_location("nl_queries_module", query_file_path)
-            queries_module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(queries_module)
-            nl_queries = getattr(queries_module, NL_QUERIES_VAR_NAME)
-        except (AttributeError, FileNotFoundError, SyntaxError) as e:
-            print(f"  - ERROR: Could not load '{NL_QUERIES_VAR_NAME}' from {query_file_path}. Error: {e}. Skipping.")
+        nl_queries = load_cached_queries(query_file_path)
+        if nl_queries is None:
             continue
 
-        # 3. Process each query
         for i, nl_query in enumerate(nl_queries, start=1):
-            print(f"  - Grading query {i}...", end="")
-            output_content = [f"--- Autograder Result for Submission {submission_id}, Query {i} ---\n"]
-            output_content.append(f"[Natural Language Query]:\n{nl_query}\n")
+            prompts.setdefault(nl_query, []).append((submission_id, output_dir, i))
 
-            generated_sql = "N/A"
-            try:
-                response = agent_executor.invoke({"input": nl_query})
-                if response.get("intermediate_steps"):
-                    for step in response["intermediate_steps"]:
-                        if step[0].tool == 'sql_db_query':
-                            generated_sql = step[0].tool_input
-                            break
-            except Exception as e:
-                generated_sql = f"Agent execution failed: {e}"
-            
-            output_content.append(f"[Generated SQL]:\n{generated_sql}\n")
-
-            gen_result, _ = execute_sql(engine, generated_sql)
-            output_content.append(f"[Result of Generated SQL]:{gen_result}\n")
-
-            golden_query_path = Path(SOLUTION_QUERIES_DIR) / f"query-{i}.sql"
-            golden_sql = "N/A"
-            golden_result = "(Golden query file not found)"
-            if golden_query_path.exists():
-                golden_sql = golden_query_path.read_text()
-                golden_result, _ = execute_sql(engine, golden_sql)
-            
-            output_content.append(f"--- Golden Solution ---\n")
-            output_content.append(f"[Golden SQL from {golden_query_path.name}]:\n{golden_sql}\n")
-            output_content.append(f"[Result of Golden SQL]:{golden_result}\n")
-
-            output_file_path = output_dir / f"result-{i}.txt"
-            output_file_path.write_text("\n".join(output_content))
-            print("Done.")
+    total_occurrences = sum(len(v) for v in prompts.values())
+    print(f"\nCollected {total_occurrences} query instances across {len(prompts)} distinct prompts.")
+
+    # 4. Second pass: resolve each distinct prompt exactly once, concurrently.
+    unique_prompts = list(prompts)
+    resolutions = await asyncio.gather(
+        *(resolve_prompt(engine, agent_executor, llm_cache, semaphore, db_semaphore, p) for p in unique_prompts),
+        return_exceptions=True,
+    )
+
+    # 5. Third pass: fan the shared outcome back out to every occurrence.
+    for nl_query, resolution in zip(unique_prompts, resolutions):
+        if isinstance(resolution, Exception):
+            generated_sql = f"Agent execution failed: {resolution}"
+            gen_result = "(No query to execute)"
+        else:
+            generated_sql, gen_result = resolution
+        for submission_id, output_dir, i in prompts[nl_query]:
+            await asyncio.to_thread(
+                write_result, output_dir, submission_id, i, nl_query,
+                generated_sql, gen_result, golden_sqls, golden_results,
+            )
+    print(f"Wrote {total_occurrences} result files.")
 
+    llm_cache.close()
+    await engine.dispose()
     print("\n--- Autograder Finished ---")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
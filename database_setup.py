@@ -32,13 +32,20 @@ def setup_database():
         
         engine = create_engine(db_creation_url, isolation_level="AUTOCOMMIT")
         with engine.connect() as connection:
-            # Check if the database exists
-            result = connection.execute(text(f"SELECT 1 FROM pg_database WHERE datname='{TEST_DATABASE_NAME}'"))
+            # Check if the database exists (bound parameter, not string
+            # interpolation, so the value is never spliced into the SQL)
+            result = connection.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                {"name": TEST_DATABASE_NAME},
+            )
             db_exists = result.scalar() == 1
-            
+
             if not db_exists:
                 print(f"Creating database '{TEST_DATABASE_NAME}'...")
-                connection.execute(text(f"CREATE DATABASE {TEST_DATABASE_NAME}"))
+                # CREATE DATABASE cannot take a bound parameter, so quote the
+                # identifier through the dialect's preparer instead.
+                quoted_db_name = engine.dialect.identifier_preparer.quote(TEST_DATABASE_NAME)
+                connection.execute(text(f"CREATE DATABASE {quoted_db_name}"))
                 print("Database created successfully.")
             else:
                 print(f"Database '{TEST_DATABASE_NAME}' already exists.")
@@ -52,8 +59,14 @@ def setup_database():
         return
 
     # Now, connect to the newly created/verified testnl2sql database.
+    # executemany_mode routes multi-row inserts through psycopg2's
+    # fast-execution helpers (one packed statement instead of one INSERT per row).
     test_db_url = base_url.set(database=TEST_DATABASE_NAME)
-    engine = create_engine(test_db_url)
+    engine = create_engine(
+        test_db_url,
+        executemany_mode="values_plus_batch",
+        executemany_values_page_size=1000,
+    )
     Session = sessionmaker(bind=engine)
     session = Session()
 
@@ -67,7 +80,7 @@ def setup_database():
             Column('user_id', Integer, primary_key=True),
             Column('username', String(50), nullable=False),
             Column('email', String(100), unique=True, nullable=False),
-            Column('registration_date', DateTime, default=datetime.datetime.utcnow)
+            Column('registration_date', DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
         )
 
         # Define 'test_orders' table
@@ -75,17 +88,25 @@ def setup_database():
             Column('order_id', Integer, primary_key=True),
             Column('user_id', Integer, nullable=False),
             Column('amount', Float, nullable=False),
-            Column('order_date', DateTime, default=datetime.datetime.utcnow)
+            Column('order_date', DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
         )
 
         # Define 'query_history' table (this is the table that will be actually used)
+        # timestamp is filled by the database (server_default) so batched log
+        # inserts don't carry a Python-computed value per row. Note:
+        # create_all() only applies this to newly created tables — an existing
+        # deployment needs `ALTER TABLE query_history ALTER COLUMN timestamp
+        # SET DEFAULT now()` once.
         query_history_table = Table('query_history', metadata,
             Column('id', Integer, primary_key=True),
-            Column('timestamp', DateTime, default=datetime.datetime.utcnow),
+            Column('timestamp', DateTime, server_default=text("now()")),
             Column('user_query_nl', String, nullable=False),
             Column('generated_sql', String, nullable=False),
             Column('execution_status', String(50), nullable=False),
-            Column('final_response_nl', String, nullable=False)
+            Column('final_response_nl', String, nullable=False),
+            # End-to-end wall time of the turn; existing deployments need
+            # `ALTER TABLE query_history ADD COLUMN latency_ms INTEGER` once.
+            Column('latency_ms', Integer)
         )
 
         metadata.create_all(engine)
@@ -1,8 +1,15 @@
 import os
+import csv
+import io
 import sys
 import glob
+import hashlib
 import importlib.util
+import argparse
 import ast
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
@@ -13,33 +20,100 @@ SUBMISSIONS_DIR = "/opt/pm883-1/dongkwang/ta/nl2sql/submissions"
 SOLUTION_QUERIES_DIR = "/opt/pm883-1/dongkwang/ta/nl2sql/solution_queries"
 RESULTS_DIR = "/opt/pm883-1/dongkwang/ta/nl2sql/grade_results"
 TEST_DATABASE_NAME = "testnl2sql"
+# Rows are streamed from the server in batches of this size instead of
+# materialized all at once, so a runaway submitted query cannot exhaust memory.
+STREAM_BATCH_SIZE = 1024
+MAX_RESULT_ROWS = 100_000
 
-def execute_sql(engine, sql_query: str) -> tuple[str, str | None]:
-    """Executes a SQL query and returns the result as a formatted string and a potential error."""
+def execute_sql(connection, sql_query: str) -> tuple[str, str | None]:
+    """Executes a SQL query on a shared connection and returns the result as a formatted string and a potential error."""
     if not sql_query or not sql_query.strip() or sql_query.strip() == "N/A":
         return "(No query to execute)", None
     try:
-        with engine.connect() as connection:
-            result = connection.execute(text(sql_query))
-            rows = result.fetchall()
-            if not rows:
-                return "(No rows returned)", None
-            
-            headers = result.keys()
-            # Format into a simple table
-            header_str = " | ".join(map(str, headers))
-            separator = "-" * len(header_str)
-            row_strs = [" | ".join(map(str, row)) for row in rows]
-            
-            return f"\n{header_str}\n{separator}\n" + "\n".join(row_strs), None
+        result = connection.execution_options(stream_results=True).execute(text(sql_query))
+
+        headers = result.keys()
+        # Format into a simple table, one server-side batch at a time.
+        # csv.writer runs the per-cell str() and separator insertion in C,
+        # which is markedly faster than a Python join per row. QUOTE_MINIMAL
+        # is set deliberately: a cell containing the delimiter, a quote, or a
+        # newline gets quote-wrapped, and the header goes through the same
+        # writer so it renders exactly like the data rows.
+        buf = io.StringIO()
+        buf.write("\n")
+        writer = csv.writer(
+            buf, delimiter="|", quotechar='"',
+            quoting=csv.QUOTE_MINIMAL, lineterminator="\n",
+        )
+        writer.writerow(list(headers))
+        header_len = buf.tell() - 2  # minus the leading and trailing newline
+        buf.write("-" * header_len + "\n")
+
+        row_count = 0
+        for partition in result.partitions(STREAM_BATCH_SIZE):
+            writer.writerows(partition)
+            row_count += len(partition)
+            if row_count >= MAX_RESULT_ROWS:
+                buf.write(f"... (output truncated at {MAX_RESULT_ROWS} rows)\n")
+                break
+        result.close()
+
+        if row_count == 0:
+            return "(No rows returned)", None
+        return buf.getvalue().rstrip("\n"), None
     except Exception as e:
+        # Reset the shared connection so the failed statement does not poison
+        # the transaction for the next query.
+        connection.rollback()
         return f"ERROR: {e}", str(e)
 
+def rowset_diff(connection, sql_a: str, sql_b: str) -> int | None:
+    """Counts the symmetric difference of two query result sets server-side.
+
+    Returns 0 when the rowsets match, a positive count when they differ, and
+    None when the combined query cannot run (e.g. incompatible column lists).
+    Only a single scalar crosses the wire instead of both full result sets.
+    """
+    sql_a = sql_a.strip().rstrip(";")
+    sql_b = sql_b.strip().rstrip(";")
+    diff_sql = (
+        f"SELECT COUNT(*) FROM ("
+        f"(({sql_a}) EXCEPT ({sql_b})) UNION ALL (({sql_b}) EXCEPT ({sql_a}))"
+        f") AS d"
+    )
+    try:
+        return connection.execute(text(diff_sql)).scalar()
+    except Exception:
+        # Reset the shared connection so the failed statement does not poison
+        # the transaction for the next query.
+        connection.rollback()
+        return None
+
+# Conventional variable names checked before falling back to a full module scan.
+QUERY_VAR_NAMES = ("sql_queries", "nlqueries", "queries")
+# Remembers which variable name worked per submission directory so re-runs
+# skip probing entirely.
+_query_var_cache: dict[str, str] = {}
+
 def load_submitted_queries(file_path: Path) -> list[str] | None:
     """Loads submitted SQL queries from a file."""
     try:
-        # First, try to evaluate the file content as a Python literal (e.g., a list of strings)
         content = file_path.read_text()
+    except OSError:
+        return None
+
+    # Cheapest first: the C JSON parser handles the common case where the file
+    # is effectively a JSON-compatible list literal, without building an AST.
+    try:
+        queries = json.loads(content)
+        if isinstance(queries, list) and all(isinstance(q, str) for q in queries):
+            print(f"  - Successfully loaded queries using json from {file_path.name}")
+            return queries
+    except json.JSONDecodeError:
+        pass
+
+    try:
+        # Next, try to evaluate the file content as a Python literal (e.g., a list of strings)
         queries = ast.literal_eval(content)
         if isinstance(queries, list) and all(isinstance(q, str) for q in queries):
             print(f"  - Successfully loaded queries using ast.literal_eval from {file_path.name}")
@@ -52,11 +126,24 @@ def load_submitted_queries(file_path: Path) -> list[str] | None:
         spec = importlib.util.spec_from_file_location("sql_queries_module", str(file_path))
         queries_module = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(queries_module)
-        # Search for a list of strings in the imported module
+
+        # Fast path: check conventional variable names (plus whichever name
+        # worked for this directory before) instead of scanning every attribute.
+        cached_name = _query_var_cache.get(str(file_path.parent))
+        candidates = (cached_name, *QUERY_VAR_NAMES) if cached_name else QUERY_VAR_NAMES
+        for var_name in candidates:
+            var = getattr(queries_module, var_name, None)
+            if isinstance(var, list) and var and all(isinstance(item, str) for item in var):
+                _query_var_cache[str(file_path.parent)] = var_name
+                print(f"  - Successfully loaded queries using importlib from variable '{var_name}' in {file_path.name}")
+                return var
+
+        # Slow path: search for any list of strings in the imported module
         for var_name in dir(queries_module):
             if not var_name.startswith("__"):
                 var = getattr(queries_module, var_name)
                 if isinstance(var, list) and all(isinstance(item, str) for item in var):
+                    _query_var_cache[str(file_path.parent)] = var_name
                     print(f"  - Successfully loaded queries using importlib from variable '{var_name}' in {file_path.name}")
                     return var
     except Exception as e:
@@ -65,9 +152,156 @@ def load_submitted_queries(file_path: Path) -> list[str] | None:
     return None
 
 
+# Extracted query lists are cached here keyed by (path, mtime) so re-runs skip
+# re-parsing and re-executing unchanged submission files.
+QUERY_CACHE_DIR = Path.home() / ".cache" / "grader"
+
+def load_cached_queries(file_path: Path) -> list[str] | None:
+    """Loads submitted queries, serving unchanged files from an on-disk cache."""
+    cache_file = None
+    try:
+        stat = file_path.stat()
+        cache_key = hashlib.sha256(f"{file_path.resolve()}|{stat.st_mtime_ns}".encode()).hexdigest()
+        cache_file = QUERY_CACHE_DIR / f"{cache_key}.json"
+        if cache_file.exists():
+            return json.loads(cache_file.read_text())
+    except (OSError, json.JSONDecodeError):
+        pass
+
+    queries = load_submitted_queries(file_path)
+    if queries is not None and cache_file is not None:
+        try:
+            QUERY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            cache_file.write_text(json.dumps(queries))
+        except OSError as e:
+            print(f"  - Warning: could not write query cache: {e}")
+    return queries
+
+
+def grade_submission(sub_dir: str, grading_plan: dict[int, tuple[str, str, str]],
+                     test_db_url: str, verbose: bool = False):
+    """Grades one submission directory in its own worker process.
+
+    Submissions are independent, so each worker builds its own engine (libpq
+    connections must not be shared across forks) and only receives picklable
+    arguments.
+    """
+    submission_id = Path(sub_dir).name.split('_')[-1]
+    print(f"\nProcessing submission: {submission_id}")
+
+    output_dir = Path(RESULTS_DIR) / submission_id
+    output_dir.mkdir(exist_ok=True)
+
+    # Find a query file to grade
+    query_file_path = None
+    possible_files = ["sql_queries.py"]
+    for filename in possible_files:
+        if (Path(sub_dir) / filename).exists():
+            query_file_path = Path(sub_dir) / filename
+            break
+
+    if not query_file_path:
+        # If no specific file found, check for any *queries.py but prioritize sql
+        all_query_files = glob.glob(f"{sub_dir}/*queries*.py")
+        if all_query_files:
+            sql_files = [f for f in all_query_files if 'sql' in f.lower()]
+            if sql_files:
+                query_file_path = Path(sql_files[0])
+            else:
+                query_file_path = Path(all_query_files[0]) # fallback to any other queries file
+
+    if not query_file_path or not query_file_path.exists():
+        print(f"  - INFO: No suitable query file found in {sub_dir}. Skipping.")
+        return
+
+    print(f"  - Found query file: {query_file_path.name}")
+    submitted_queries = load_cached_queries(query_file_path)
+
+    if not submitted_queries:
+        print(f"  - ERROR: Could not load any queries from {query_file_path}. Skipping.")
+        return
+
+    print(f"  - Loaded {len(submitted_queries)} submitted queries.")
+
+    engine = create_engine(
+        test_db_url,
+        pool_size=2,
+        max_overflow=0,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        executemany_mode="values_plus_batch",
+        executemany_values_page_size=1000,
+    )
+    connection = engine.connect()
+    try:
+        # Process each query and print/save results
+        for i, submitted_sql in enumerate(submitted_queries, start=1):
+            print(f"  - Grading query {i}...")
+
+            # Execute submitted query
+            submitted_result, _ = execute_sql(connection, submitted_sql)
+
+            # One plan lookup replaces the per-iteration dict probes and
+            # filename formatting
+            plan_entry = grading_plan.get(i)
+            if plan_entry is not None:
+                solution_sql, solution_result, result_filename = plan_entry
+            else:
+                solution_sql, solution_result, result_filename = "N/A", "(No query to execute)", f"result-{i}.txt"
+
+            # Primary correctness signal: a server-side set diff of the two
+            # rowsets, so only one scalar crosses the wire per query.
+            diff_count = None
+            if solution_sql != "N/A" and submitted_sql and submitted_sql.strip() not in ("", "N/A"):
+                diff_count = rowset_diff(connection, submitted_sql, solution_sql)
+            if diff_count is None:
+                diff_str = "(not comparable)"
+            else:
+                diff_str = f"{diff_count} ({'MATCH' if diff_count == 0 else 'MISMATCH'})"
+            print(f"  - Query {i}: rowset diff vs golden = {diff_str}")
+
+            if verbose:
+                # Print full result sets to console for inspection
+                print(f"\n--- Query {i} Results (Submission: {submission_id}) ---")
+                print("--- Submitted Query Result ---")
+                print(submitted_result)
+                print("\n--- Solution Query Result ---")
+                print(solution_result)
+                print("--------------------------------------------------\n")
+
+            # Save results to a file for the specific query
+            output_content = [
+                f"--- Autograder Result for Submission {submission_id}, Query {i} ---\n",
+                f"[Submitted SQL from {query_file_path.name}]:\n{submitted_sql}\n",
+                f"[Result of Submitted SQL]:{submitted_result}\n",
+                f"[Rowset Diff vs Golden]: {diff_str}\n",
+                "--- Golden Solution ---\n",
+                f"[Golden SQL from query-{i}.sql]:\n{solution_sql}\n",
+                f"[Result of Golden SQL]:{solution_result}\n"
+            ]
+            # One pre-encoded buffer and one write() per file; on the shared
+            # filesystem the syscall count dominates small-file writes.
+            buf = bytearray()
+            for part in output_content:
+                buf += part.encode()
+                buf += b"\n"
+            output_file_path = output_dir / result_filename
+            output_file_path.write_bytes(bytes(buf))
+    finally:
+        connection.close()
+        engine.dispose()
+
+    print(f"  - Grading for submission {submission_id} complete. Results saved in {output_dir}")
+
+
 def main():
     """Main function to run the SQL grader."""
     # 1. Setup
+    parser = argparse.ArgumentParser(description="Grade submitted SQL queries against the golden solutions.")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print full result sets to the console instead of just the rowset diff")
+    args = parser.parse_args()
+
     print("--- Starting SQL Grader ---")
     load_dotenv()
 
@@ -79,9 +313,20 @@ def main():
     test_db_url = db_url_obj.set(database=TEST_DATABASE_NAME)
     
     try:
-        engine = create_engine(str(test_db_url))
-        with engine.connect() as conn:
-            pass
+        # One pooled engine for the whole run; pre-ping revives stale
+        # connections instead of failing mid-grade.
+        engine = create_engine(
+            str(test_db_url),
+            pool_size=32,
+            max_overflow=0,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            executemany_mode="values_plus_batch",
+            executemany_values_page_size=1000,
+        )
+        # A single long-lived connection is reused for every query execution,
+        # avoiding a pool checkout/checkin per statement.
+        connection = engine.connect()
         print(f"Successfully connected to test database: {TEST_DATABASE_NAME}")
     except Exception as e:
         print(f"FATAL: Could not connect to test database '{TEST_DATABASE_NAME}'. Error: {e}", file=sys.stderr)
@@ -90,8 +335,17 @@ def main():
     Path(RESULTS_DIR).mkdir(exist_ok=True)
 
     # 2. Load solution queries
+    # os.scandir does one getdents pass instead of a stat per fnmatch entry,
+    # which matters on the shared filesystem these directories live on.
     solution_queries = {}
-    solution_files = sorted(glob.glob(f"{SOLUTION_QUERIES_DIR}/query-*.sql"))
+    try:
+        with os.scandir(SOLUTION_QUERIES_DIR) as it:
+            solution_files = sorted(
+                e.path for e in it
+                if e.is_file() and e.name.startswith("query-") and e.name.endswith(".sql")
+            )
+    except FileNotFoundError:
+        solution_files = []
     for sol_file in solution_files:
         try:
             query_num = int(Path(sol_file).stem.split('-')[1])
@@ -101,84 +355,50 @@ def main():
 
     print(f"Loaded {len(solution_queries)} solution queries.")
 
+    # Execute each golden query exactly once: the result is identical for every
+    # submission, so re-running them inside the submission loop is pure waste.
+    golden_results = {i: execute_sql(connection, sql) for i, sql in solution_queries.items()}
+    print(f"Pre-executed {len(golden_results)} golden queries.")
+
+    # Precompute the per-query grading plan: golden SQL, golden result string
+    # and output filename are invariant across submissions, so the workers'
+    # inner loops reduce to a single dict lookup per query.
+    grading_plan = {
+        i: (sql, golden_results[i][0], f"result-{i}.txt")
+        for i, sql in solution_queries.items()
+    }
+
     # 3. Find and process submissions
-    submission_dirs = glob.glob(f"{SUBMISSIONS_DIR}/submission_*/")
+    try:
+        with os.scandir(SUBMISSIONS_DIR) as it:
+            submission_dirs = sorted(
+                e.path for e in it if e.is_dir() and e.name.startswith("submission_")
+            )
+    except FileNotFoundError:
+        submission_dirs = []
     if not submission_dirs:
         print(f"Warning: No submission directories found in {SUBMISSIONS_DIR}")
         return
 
     print(f"Found {len(submission_dirs)} submissions to process.")
 
-    for sub_dir in sorted(submission_dirs):
-        submission_id = Path(sub_dir).name.split('_')[-1]
-        print(f"\nProcessing submission: {submission_id}")
-
-        output_dir = Path(RESULTS_DIR) / submission_id
-        output_dir.mkdir(exist_ok=True)
-
-        # Find a query file to grade
-        query_file_path = None
-        possible_files = ["sql_queries.py"]
-        for filename in possible_files:
-            if (Path(sub_dir) / filename).exists():
-                query_file_path = Path(sub_dir) / filename
-                break
-        
-        if not query_file_path:
-            # If no specific file found, check for any *queries.py but prioritize sql
-            all_query_files = glob.glob(f"{sub_dir}/*queries*.py")
-            if all_query_files:
-                sql_files = [f for f in all_query_files if 'sql' in f.lower()]
-                if sql_files:
-                    query_file_path = Path(sql_files[0])
-                else:
-                    query_file_path = Path(all_query_files[0]) # fallback to any other queries file
-            
-        if not query_file_path or not query_file_path.exists():
-            print(f"  - INFO: No suitable query file found in {sub_dir}. Skipping.")
-            continue
-        
-        print(f"  - Found query file: {query_file_path.name}")
-        submitted_queries = load_submitted_queries(query_file_path)
-
-        if not submitted_queries:
-            print(f"  - ERROR: Could not load any queries from {query_file_path}. Skipping.")
-            continue
-
-        print(f"  - Loaded {len(submitted_queries)} submitted queries.")
-        
-        # 4. Process each query and print/save results
-        for i, submitted_sql in enumerate(submitted_queries, start=1):
-            print(f"  - Grading query {i}...")
-            
-            # Execute submitted query
-            submitted_result, _ = execute_sql(engine, submitted_sql)
-            
-            # Get and execute solution query
-            solution_sql = solution_queries.get(i, "N/A")
-            solution_result, _ = execute_sql(engine, solution_sql)
-
-            # Print to console for inspection
-            print(f"\n--- Query {i} Results (Submission: {submission_id}) ---")
-            print("--- Submitted Query Result ---")
-            print(submitted_result)
-            print("\n--- Solution Query Result ---")
-            print(solution_result)
-            print("--------------------------------------------------\n")
+    # The golden pre-execution connection is not needed (or fork-safe) once
+    # workers take over.
+    connection.close()
+    engine.dispose()
 
-            # Save results to a file for the specific query
-            output_content = [
-                f"--- Autograder Result for Submission {submission_id}, Query {i} ---\n",
-                f"[Submitted SQL from {query_file_path.name}]:\n{submitted_sql}\n",
-                f"[Result of Submitted SQL]:{submitted_result}\n",
-                "--- Golden Solution ---\n",
-                f"[Golden SQL from query-{i}.sql]:\n{solution_sql}\n",
-                f"[Result of Golden SQL]:{solution_result}\n"
-            ]
-            output_file_path = output_dir / f"result-{i}.txt"
-            output_file_path.write_text("\n".join(output_content))
-        
-        print(f"  - Grading for submission {submission_id} complete. Results saved in {output_dir}")
+    # 4. Grade submissions in parallel: each is independent (own engine, own
+    # output directory), so the work fans out across all cores.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(
+            partial(
+                grade_submission,
+                grading_plan=grading_plan,
+                test_db_url=str(test_db_url),
+                verbose=args.verbose,
+            ),
+            submission_dirs,
+        ))
 
     print("\n--- Grader Finished ---")
 
@@ -1,17 +1,31 @@
 import os
-import datetime
+import argparse
+import ast
+import asyncio
+import functools
+import hashlib
+import json
+import math
+import pickle
+import re
+import sqlite3
 import sys
+import threading
+import time
+from pathlib import Path
 from dotenv import load_dotenv
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.sql_database import SQLDatabase
-from langchain.agents import create_sql_agent
-from langchain.memory import ConversationBufferMemory
-from langchain_core.rate_limiters import InMemoryRateLimiter
+# The heavy langchain imports are deferred into main(): they account for most
+# of the CLI's cold start, and the env check / database menu shouldn't pay for
+# them. Only the lightweight langchain_core base class is needed at module
+# scope (AsyncTokenBucket subclasses it).
+from langchain_core.messages import trim_messages
+from langchain_core.rate_limiters import BaseRateLimiter
 
 
 from sqlalchemy import create_engine, MetaData, Table
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 
 # Import function and variable from database_setup.py
 from database_setup import setup_database as setup_test_database, TEST_DATABASE_NAME
@@ -22,149 +36,778 @@ LOGGING_DATABASE_NAME = TEST_DATABASE_NAME
 engine = None
 query_history_table = None
 
-def setup_logging():
+# Reflecting query_history hits information_schema on every process start; a
+# pickled copy of the MetaData lets repeat CLI sessions skip those queries.
+METADATA_CACHE_PATH = Path(".cache/meta.pkl")
+# Columns the logging code writes. A cached pickle missing any of them was
+# taken before a schema migration and must be re-reflected, or the code would
+# silently skip those columns forever.
+EXPECTED_LOG_COLUMNS = {
+    "user_query_nl", "generated_sql", "execution_status",
+    "final_response_nl", "latency_ms",
+}
+
+# The agent's schema reflection repeats identical information_schema queries on
+# every start; the reflected MetaData is pickled per database URL instead.
+SCHEMA_CACHE_DIR = Path.home() / ".cache" / "nl2sql"
+
+def _load_cached_schema(db_url: str) -> tuple[Path, MetaData | None]:
+    """Returns the schema cache file for a database URL and its contents, if any."""
+    cache_file = SCHEMA_CACHE_DIR / f"{hashlib.sha1(db_url.encode()).hexdigest()}.pkl"
+    try:
+        with open(cache_file, "rb") as f:
+            return cache_file, pickle.load(f)
+    except (OSError, pickle.UnpicklingError, AttributeError):
+        return cache_file, None
+
+# Agent tracing (chain-of-thought prints, intermediate step collection) is
+# useful when debugging but pure overhead in normal runs; gate it on an env var.
+DEBUG = os.getenv("NL2SQL_DEBUG", "0") == "1"
+
+# Response caching is opt-in (NL2SQL_CACHE=1): the LLM runs at temperature 0.5,
+# so replaying a cached answer trades freshness for skipping the ~8s LLM call.
+RESPONSE_CACHE_ENABLED = os.getenv("NL2SQL_CACHE", "0") == "1"
+RESPONSE_CACHE_PATH = ".cache/response_cache.sqlite"
+
+# Minimum cosine similarity for the semantic cache tier to treat two questions
+# as the same. 0.95 only matches rephrasings, not merely related questions.
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+class ResponseCache:
+    """Cache of agent responses, keyed by (database, question, chat history).
+
+    A repeated question in the same conversational state short-circuits the
+    whole agent invocation to a SQLite lookup. When fastembed is installed, a
+    second tier embeds questions with a small local model (no API calls) so
+    near-duplicate phrasings also hit; without fastembed the cache is
+    exact-match only.
     """
-    Initializes the connection to the dedicated logging database ('testnl2sql') and the table object.
-    It gets connection info from the DATABASE_URL in .env but hardcodes the database name to 'testnl2sql'.
+
+    # Embedding model shared across instances, loaded lazily on first use.
+    _embed_model = None
+    _embed_unavailable = False
+
+    def __init__(self, path: str, db_url: str):
+        Path(path).parent.mkdir(exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache "
+            "(key TEXT PRIMARY KEY, output TEXT NOT NULL, generated_sql TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_embeddings "
+            "(key TEXT PRIMARY KEY, hist TEXT NOT NULL, embedding TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self._db_url = db_url
+
+    def _key(self, user_input: str, history: str) -> str:
+        payload = json.dumps({"db": self._db_url, "q": user_input, "hist": history}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _hist_key(self, history: str) -> str:
+        return hashlib.sha256(f"{self._db_url}|{history}".encode()).hexdigest()
+
+    @classmethod
+    def _embed(cls, text: str) -> list[float] | None:
+        """Embeds text with a local quantized model, or None if fastembed is missing."""
+        if cls._embed_unavailable:
+            return None
+        if cls._embed_model is None:
+            try:
+                from fastembed import TextEmbedding
+                cls._embed_model = TextEmbedding("BAAI/bge-small-en-v1.5")
+            except Exception:
+                # fastembed (or its model download) is optional; fall back to
+                # exact matching and don't retry the import every turn.
+                cls._embed_unavailable = True
+                return None
+        return [float(x) for x in next(iter(cls._embed_model.embed([text])))]
+
+    def _semantic_get(self, user_input: str, history: str) -> tuple[str, str] | None:
+        """Finds a cached answer whose question is a near-duplicate of this one."""
+        query_vec = self._embed(user_input)
+        if query_vec is None:
+            return None
+        q_norm = math.sqrt(sum(x * x for x in query_vec)) or 1.0
+        best_key = None
+        best_score = SEMANTIC_CACHE_THRESHOLD
+        # Only compare against entries from the same database + conversational
+        # state; a match in a different context would be wrong, not stale.
+        rows = self._conn.execute(
+            "SELECT key, embedding FROM response_embeddings WHERE hist = ?",
+            (self._hist_key(history),),
+        )
+        for key, embedding_json in rows:
+            vec = json.loads(embedding_json)
+            norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+            score = sum(a * b for a, b in zip(query_vec, vec)) / (q_norm * norm)
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        row = self._conn.execute(
+            "SELECT output, generated_sql FROM response_cache WHERE key = ?",
+            (best_key,),
+        ).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def get(self, user_input: str, history: str) -> tuple[str, str] | None:
+        row = self._conn.execute(
+            "SELECT output, generated_sql FROM response_cache WHERE key = ?",
+            (self._key(user_input, history),),
+        ).fetchone()
+        if row is not None:
+            return (row[0], row[1])
+        return self._semantic_get(user_input, history)
+
+    def put(self, user_input: str, history: str, output: str, generated_sql: str) -> None:
+        key = self._key(user_input, history)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, output, generated_sql) VALUES (?, ?, ?)",
+            (key, output, str(generated_sql)),
+        )
+        embedding = self._embed(user_input)
+        if embedding is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_embeddings (key, hist, embedding) VALUES (?, ?, ?)",
+                (key, self._hist_key(history), json.dumps(embedding)),
+            )
+        self._conn.commit()
+
+class AsyncTokenBucket(BaseRateLimiter):
+    """Token-bucket rate limiter that sleeps exactly until a token is available.
+
+    InMemoryRateLimiter wakes up every check_every_n_seconds to poll its clock;
+    this computes the current deficit and sleeps once for exactly that long, so
+    during the wait the event loop is free to run log flushes and other tasks.
+    """
+
+    def __init__(self, requests_per_second: float, max_bucket_size: float = 1.0):
+        self.rate = requests_per_second
+        self.capacity = max_bucket_size
+        self.tokens = max_bucket_size
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def _take(self) -> float:
+        """Takes one token, returning how long to sleep for it to be covered."""
+        with self._lock:
+            self._refill()
+            self.tokens -= 1.0
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def _try_take(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        if not blocking:
+            return self._try_take()
+        wait = self._take()
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        if not blocking:
+            return self._try_take()
+        wait = self._take()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+# For count/list style questions with tiny results, the model's paraphrase of
+# the rows adds nothing — show the rows verbatim instead.
+# Deterministic router: inputs that are already SQL need no LLM at all, so a
+# raw SELECT is executed directly against the database and its rowset printed.
+ROUTER = re.compile(r"^\s*select\b", re.IGNORECASE)
+
+FASTPATH_MAX_ROWS = 5
+SIMPLE_QUERY_RE = re.compile(r"(how many|count|list (?:all|the)|show (?:all|me))", re.I)
+
+def format_small_result(observation) -> str | None:
+    """Returns a SQL observation formatted as plain rows if it is small.
+
+    Returns None when the observation does not parse as a rowset or the result
+    is too large to present verbatim.
     """
-    global engine, query_history_table
-    BASE_DATABASE_URL = os.getenv("DATABASE_URL")
-    if not BASE_DATABASE_URL:
-        print(f"Warning: DATABASE_URL for logging is not set in .env. Logs for {LOGGING_DATABASE_NAME} will not be recorded.")
+    try:
+        rows = ast.literal_eval(str(observation))
+    except (SyntaxError, ValueError):
+        return None
+    if isinstance(rows, list) and 0 < len(rows) <= FASTPATH_MAX_ROWS:
+        return "\n".join(" | ".join(map(str, row)) for row in rows)
+    return None
+
+# Log rows flow through a bounded queue into one background writer task, which
+# drains up to LOG_BATCH_SIZE rows per INSERT (or whatever arrived within the
+# batch window). This amortizes connection checkout + commit over many turns
+# and keeps the foreground loop to a non-blocking put.
+LOG_BATCH_SIZE = 32
+LOG_BATCH_WINDOW_SECONDS = 1.0
+LOG_QUEUE_MAXSIZE = 1024
+_log_queue: asyncio.Queue | None = None
+_log_worker_task: asyncio.Task | None = None
+# Set when the agent's sync engine doubles as the logging engine (same
+# database), so the process runs one connection pool instead of two.
+_sync_log_engine = None
+# Compiled once in setup_logging(); every batch reuses the same insert
+# construct instead of rebuilding (and re-stringifying) it per flush.
+_insert_stmt = None
+
+def _sync_write_batch(rows: list[dict]):
+    with _sync_log_engine.begin() as connection:
+        connection.execute(_insert_stmt, rows)
+
+async def _write_log_batch(rows: list[dict]):
+    """Writes one batch of log rows with a single executemany INSERT."""
+    try:
+        if _sync_log_engine is not None:
+            # Shared sync engine: run the write in a worker thread so the
+            # event loop stays free while the INSERT is in flight.
+            await asyncio.to_thread(_sync_write_batch, rows)
+        else:
+            async with engine.begin() as connection:
+                await connection.execute(_insert_stmt, rows)
+    except Exception as e:
+        print(f"Failed to write log to database: {e}")
+
+async def _log_worker():
+    """Drains the log queue forever, batching rows up to size/time limits."""
+    while True:
+        batch = [await _log_queue.get()]
+        deadline = time.monotonic() + LOG_BATCH_WINDOW_SECONDS
+        while len(batch) < LOG_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_log_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        await _write_log_batch(batch)
+        for _ in batch:
+            _log_queue.task_done()
+
+async def _drain_logs():
+    """Waits until every queued log row has been written, then stops the worker."""
+    global _log_worker_task
+    if _log_queue is None or _log_worker_task is None:
         return
+    await _log_queue.join()
+    _log_worker_task.cancel()
+    try:
+        await _log_worker_task
+    except asyncio.CancelledError:
+        pass
+    _log_worker_task = None
+
+async def setup_logging(base_url, shared_engine=None):
+    """
+    Initializes the connection to the dedicated logging database ('testnl2sql') and the table object.
+    It takes the already-parsed DATABASE_URL but hardcodes the database name to 'testnl2sql'.
+    When shared_engine (the agent's sync engine) already points at the logging
+    database, it is reused instead of opening a second connection pool.
+    """
+    global engine, query_history_table, _sync_log_engine
 
     try:
-        # Parse the URL and change only the database name to LOGGING_DATABASE_NAME
-        base_url = make_url(BASE_DATABASE_URL)
-        log_db_url = base_url.set(database=LOGGING_DATABASE_NAME)
-        
-        engine = create_engine(log_db_url)
-        metadata = MetaData()
-        # Load existing table information from the database.
-        query_history_table = Table('query_history', metadata, autoload_with=engine)
-        print(f"Connected to logging database '{engine.url.database}'.")
+        if shared_engine is not None:
+            _sync_log_engine = shared_engine
+        else:
+            # Change only the database name to LOGGING_DATABASE_NAME;
+            # asyncpg lets log writes overlap with LLM decoding and the next prompt.
+            log_db_url = base_url.set(database=LOGGING_DATABASE_NAME, drivername="postgresql+asyncpg")
+
+            # LIFO checkout keeps reusing the same warm connections (better PG
+            # backend cache locality); pre-ping revives ones idled out by the
+            # server instead of failing the first log write after a pause.
+            engine = create_async_engine(
+                log_db_url,
+                pool_size=int(os.getenv("LOG_POOL_SIZE", "5")),
+                max_overflow=5,
+                pool_pre_ping=True,
+                pool_use_lifo=os.getenv("LOG_POOL_LIFO", "1") == "1",
+                pool_recycle=1800,
+            )
+        try:
+            # Fast path: rehydrate the reflected metadata from the local cache.
+            with open(METADATA_CACHE_PATH, "rb") as f:
+                metadata = pickle.load(f)
+            query_history_table = metadata.tables["query_history"]
+            # Stale-schema check: a pickle from before a migration would make
+            # the code skip newer columns forever. (If the database itself
+            # still lacks a column, re-reflection happens each start until the
+            # documented ALTER is applied — correct, just not cached.)
+            if not EXPECTED_LOG_COLUMNS.issubset(query_history_table.c.keys()):
+                raise KeyError("cached query_history schema is stale")
+        except (OSError, pickle.UnpicklingError, KeyError, AttributeError):
+            # Slow path: load existing table information from the database and
+            # cache it for the next session.
+            metadata = MetaData()
+            if shared_engine is not None:
+                query_history_table = await asyncio.to_thread(
+                    lambda: Table('query_history', metadata, autoload_with=shared_engine)
+                )
+            else:
+                async with engine.connect() as connection:
+                    query_history_table = await connection.run_sync(
+                        lambda sync_conn: Table('query_history', metadata, autoload_with=sync_conn)
+                    )
+            try:
+                METADATA_CACHE_PATH.parent.mkdir(exist_ok=True)
+                with open(METADATA_CACHE_PATH, "wb") as f:
+                    pickle.dump(metadata, f)
+            except OSError:
+                pass # Cache is an optimization only; reflection already succeeded.
+
+        global _log_queue, _log_worker_task, _insert_stmt
+        _insert_stmt = query_history_table.insert()
+        _log_queue = asyncio.Queue(maxsize=LOG_QUEUE_MAXSIZE)
+        _log_worker_task = asyncio.create_task(_log_worker())
+        if shared_engine is not None:
+            print(f"Logging shares the agent's connection pool ('{shared_engine.url.database}').")
+        else:
+            print(f"Connected to logging database '{engine.url.database}'.")
     except Exception as e:
         print(f"Warning: Logging database connection failed. Logs will not be recorded. Error: {e}")
         engine = None
+        _sync_log_engine = None
         query_history_table = None
 
-def log_interaction(user_query, generated_sql, status, final_response):
-    """Logs the interaction details to the query_history table."""
-    if engine is None or query_history_table is None:
+def log_interaction(user_query, generated_sql, status, final_response, latency_ms=None):
+    """Queues the interaction details; the background worker writes them in batches."""
+    if (engine is None and _sync_log_engine is None) or query_history_table is None or _log_queue is None:
         return # If logging is not set up, exit the function
 
-    with engine.connect() as connection:
-        try:
-            insert_stmt = query_history_table.insert().values(
-                timestamp=datetime.datetime.utcnow(),
-                user_query_nl=user_query,
-                generated_sql=str(generated_sql),
-                execution_status=status,
-                final_response_nl=final_response
-            )
-            connection.execute(insert_stmt)
-            connection.commit()
-        except Exception as e:
-            print(f"Failed to write log to database: {e}")
+    # timestamp is intentionally omitted: the column's server_default fills it
+    # in the database, so batched inserts ship one less value per row.
+    row = dict(
+        user_query_nl=user_query,
+        generated_sql=str(generated_sql),
+        execution_status=status,
+        final_response_nl=final_response
+    )
+    # Older deployments (and cached metadata from them) predate latency_ms;
+    # only include it when the reflected table actually has the column.
+    if latency_ms is not None and "latency_ms" in query_history_table.c:
+        row["latency_ms"] = latency_ms
+    try:
+        _log_queue.put_nowait(row)
+    except asyncio.QueueFull:
+        print("Warning: log queue is full; dropping a query_history row.")
+
+# Maximum number of concurrent agent runs in batch mode. The token bucket
+# still paces the individual LLM calls; this only caps in-flight runs.
+BATCH_CONCURRENCY = 8
+
+async def run_batch(agent_executor, batch_path: str, out_path: str):
+    """Runs every prompt from a JSONL file concurrently and stores the results in SQLite."""
+    prompts = []
+    with open(batch_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            prompts.append(record["input"] if isinstance(record, dict) else str(record))
+    print(f"Loaded {len(prompts)} prompts from {batch_path}.")
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_one(prompt: str) -> tuple[str, str, str, str]:
+        async with semaphore:
+            try:
+                response = await agent_executor.ainvoke({"input": prompt})
+            except Exception as e:
+                return prompt, f"An error occurred: {e}", "N/A", "Error"
+        output = response.get("output", "Could not find an answer.")
+        generated_sql = "N/A"
+        for step in response.get("intermediate_steps") or []:
+            if step[0].tool == 'sql_db_query':
+                generated_sql = step[0].tool_input
+                break
+        return prompt, output, str(generated_sql), "Success"
+
+    results = await asyncio.gather(*(run_one(p) for p in prompts))
+
+    # One executemany for the whole run; also mirror each turn into the usual
+    # query_history log.
+    conn = sqlite3.connect(out_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS results "
+        "(prompt TEXT, output TEXT, generated_sql TEXT, status TEXT)"
+    )
+    conn.executemany("INSERT INTO results VALUES (?, ?, ?, ?)", results)
+    conn.commit()
+    conn.close()
+    for prompt, output, generated_sql, status in results:
+        log_interaction(prompt, generated_sql, status, output)
+    print(f"Batch finished: {len(results)} prompts -> {out_path}")
 
-def main():
+async def main():
     """
     Main execution function: Handles the interactive CLI and logs all interactions.
     """
+    parser = argparse.ArgumentParser(description="LangChain + Gemini NL-to-SQL chatbot")
+    parser.add_argument("--batch", metavar="INPUT_JSONL",
+                        help="run all prompts from a JSONL file instead of the interactive CLI")
+    parser.add_argument("--out", default="batch_results.sqlite",
+                        help="SQLite file for batch-mode results (default: %(default)s)")
+    args = parser.parse_args()
+
     # 1. Load environment variables
     load_dotenv()
 
     if not os.getenv("GOOGLE_API_KEY") or not os.getenv("DATABASE_URL"):
         raise ValueError("GOOGLE_API_KEY or DATABASE_URL is not set in the .env file.")
 
+    # Parse DATABASE_URL exactly once; everything downstream (agent engine,
+    # logging engine, test-DB URL) derives from this URL object.
+    base_url_obj = make_url(os.environ["DATABASE_URL"])
+
     print("Environment variables loaded successfully.")
 
-    # 2. Select database to use
-    print("\nWhich database would you like to connect to?")
-    print(f"  1. Test Database ({TEST_DATABASE_NAME})")
-    print("  2. Database specified in .env file")
-    choice = input("Select (1 or 2): ")
+    # 2. Select database to use (batch mode skips the prompt and uses .env)
+    if args.batch:
+        choice = '2'
+    else:
+        print("\nWhich database would you like to connect to?")
+        print(f"  1. Test Database ({TEST_DATABASE_NAME})")
+        print("  2. Database specified in .env file")
+        choice = input("Select (1 or 2): ")
 
     db_url_to_use = None
-    base_db_url_str = os.getenv("DATABASE_URL")
 
     if choice == '1':
         print("\nChecking and preparing the test database...")
         setup_test_database() # Create/verify database and tables
-        
+
         # Create URL for the test DB
-        url_obj = make_url(base_db_url_str)
-        test_db_url = url_obj.set(database=TEST_DATABASE_NAME)
-        db_url_to_use = str(test_db_url)
+        test_db_url = base_url_obj.set(database=TEST_DATABASE_NAME)
+        db_url_to_use = test_db_url.render_as_string(hide_password=False)
         print(f"Using the test database '{TEST_DATABASE_NAME}'.")
 
     elif choice == '2':
-        db_url_to_use = base_db_url_str
+        db_url_to_use = base_url_obj.render_as_string(hide_password=False)
         print("Using the database specified in .env.")
     
     else:
         print("Invalid choice. Exiting program.", file=sys.stderr)
         sys.exit(1)
 
-    # Set up logging database connection (uses testnl2sql regardless of choice)
-    # If test DB was chosen, setup_test_database() was already called, so the logging DB is ready.
-    setup_logging()
+    # Deferred imports: loading langchain + the Google client takes a couple
+    # of seconds, so it happens only once the session is actually starting.
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from langchain.sql_database import SQLDatabase
+    from langchain.agents import create_sql_agent
+    from langchain.memory import ConversationSummaryBufferMemory
+    from langchain_community.chat_message_histories import SQLChatMessageHistory
 
     # 3. Initialize LLM
     # llm = ChatTogether(model="deepseek-ai/DeepSeek-R1-Distill-Llama-70B-free", temperature=0, max_retries=3)
-    rate_limiter = InMemoryRateLimiter(
+    rate_limiter = AsyncTokenBucket(
         requests_per_second=0.15,  # We can only make a request once every 6.67 seconds!!
-        check_every_n_seconds=0.5,  # Wake up every 100 ms to check whether allowed to make a request,
         max_bucket_size=3,  # Controls the maximum burst size.
     )
 
     llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.5, max_retries=2, rate_limiter=rate_limiter)
     print("Gemini LLM initialized successfully.")
 
-    # 4. Connect agent to the database (the one chosen by the user)
-    db = SQLDatabase.from_uri(db_url_to_use)
+    # 4. Connect agent to the database (the one chosen by the user), with the
+    # same warm-connection-reuse pool settings as the logging engine
+    agent_engine_args = {"pool_size": 10, "pool_use_lifo": True, "pool_pre_ping": True}
+    schema_cache_file, cached_metadata = _load_cached_schema(db_url_to_use)
+    if cached_metadata is not None:
+        # Pre-populated metadata makes reflection skip the tables it already
+        # knows, removing those round-trips from cold start.
+        db = SQLDatabase(
+            engine=create_engine(db_url_to_use, **agent_engine_args),
+            metadata=cached_metadata,
+        )
+        print("Schema metadata loaded from cache.")
+    else:
+        db = SQLDatabase.from_uri(db_url_to_use, engine_args=agent_engine_args)
+        try:
+            SCHEMA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with open(schema_cache_file, "wb") as f:
+                pickle.dump(db._metadata, f)
+        except (OSError, pickle.PicklingError):
+            pass # Cache is an optimization only; reflection already succeeded.
+
+    # The schema text handed to the LLM is identical per table list, so
+    # memoize it instead of re-rendering (and re-querying) every turn.
+    get_table_info_uncached = db.get_table_info
+
+    @functools.lru_cache(maxsize=64)
+    def _cached_table_info(table_names: tuple | None) -> str:
+        return get_table_info_uncached(list(table_names) if table_names else None)
+
+    db.get_table_info = lambda table_names=None: _cached_table_info(
+        tuple(sorted(table_names)) if table_names else None
+    )
     print(f"Agent connected to database '{db._engine.url.database}'.")
 
-    # 5. Set up conversation memory
-    memory = ConversationBufferMemory(memory_key="chat_history", input_key="input", return_messages=True)
+    # Set up logging (uses testnl2sql regardless of choice). When the agent is
+    # already connected to the logging database, its pool is shared instead of
+    # opening a second one; otherwise a dedicated async engine is created.
+    # If test DB was chosen, setup_test_database() was already called, so the logging DB is ready.
+    shared_log_engine = db._engine if db._engine.url.database == LOGGING_DATABASE_NAME else None
+    await setup_logging(base_url_obj, shared_engine=shared_log_engine)
+
+    # Optional Gemini context caching (NL2SQL_PREFIX_CACHE=1): the schema text
+    # is static for a session, so uploading it once as cached content means it
+    # is referenced by id on every call instead of re-sent and re-prefilled.
+    # The chat history must only ever be appended after this prefix.
+    if os.getenv("NL2SQL_PREFIX_CACHE", "0") == "1":
+        try:
+            from google.generativeai import caching as genai_caching
+
+            prefix_cache = genai_caching.CachedContent.create(
+                model="gemini-2.5-flash",
+                system_instruction=(
+                    "You are an agent designed to interact with a SQL database.\n"
+                    "The database schema is:\n" + db.get_table_info()
+                ),
+                ttl="3600s",
+            )
+            llm = ChatGoogleGenerativeAI(
+                model="gemini-2.5-flash", temperature=0.5, max_retries=2,
+                rate_limiter=rate_limiter, cached_content=prefix_cache.name,
+            )
+            print("Gemini context cache created; the schema prefix is no longer retransmitted.")
+        except Exception as e:
+            print(f"Warning: could not create Gemini context cache ({e}). Continuing without it.")
+
+    # Batch mode: the prompts are independent, so the agent runs without
+    # conversation memory and everything is fanned out through one gather.
+    if args.batch:
+        batch_agent = create_sql_agent(
+            llm=llm,
+            db=db,
+            agent_type="tool-calling",
+            verbose=DEBUG,
+            handle_parsing_errors=True,
+            # Batch mode reads the generated SQL out of the intermediate
+            # steps, so they stay on regardless of DEBUG.
+            return_intermediate_steps=True
+        )
+        await run_batch(batch_agent, args.batch, args.out)
+        await _drain_logs()
+        if engine is not None:
+            await engine.dispose()
+        return
+
+    class PersistentSummaryBufferMemory(ConversationSummaryBufferMemory):
+        """Summary-buffer memory whose pruning reaches a SQL-backed history.
+
+        ConversationSummaryBufferMemory.prune() pops from the list returned by
+        chat_memory.messages, but SQLChatMessageHistory rebuilds that list
+        from the database on every access, so the pops never persist: once a
+        session crossed the token limit, every turn would re-summarize the
+        same head with a fresh rate-limited LLM call while the store kept
+        growing. This override writes the pruned buffer back to the store the
+        same way the per-turn trim does.
+        """
+
+        def prune(self) -> None:
+            buffer = self.chat_memory.messages
+            curr_buffer_length = self.llm.get_num_tokens_from_messages(buffer)
+            if curr_buffer_length <= self.max_token_limit:
+                return
+            pruned_memory = []
+            while curr_buffer_length > self.max_token_limit and buffer:
+                pruned_memory.append(buffer.pop(0))
+                curr_buffer_length = self.llm.get_num_tokens_from_messages(buffer)
+            self.moving_summary_buffer = self.predict_new_summary(
+                pruned_memory, self.moving_summary_buffer
+            )
+            self.chat_memory.clear()
+            self.chat_memory.add_messages(buffer)
+
+    # 5. Set up conversation memory. The summary buffer keeps the last turns
+    # verbatim and rolls older ones into a summary, so prompt size (and
+    # per-turn prefill cost) stays bounded no matter how long the session runs.
+    # Backing it with SQLChatMessageHistory persists the history in the
+    # logging database, so a restarted CLI resumes its session (keyed by
+    # SESSION_ID) instead of rebuilding context from scratch.
+    memory_kwargs = dict(
+        llm=llm,
+        max_token_limit=1500,
+        memory_key="chat_history",
+        input_key="input",
+        return_messages=True,
+    )
+    try:
+        # Reuse the pooled logging engine when logging shares the agent's sync
+        # engine; otherwise hand over a sync URL (the dedicated log engine is
+        # asyncpg, which the history's sync calls can't use).
+        history_connection = _sync_log_engine or base_url_obj.set(
+            database=LOGGING_DATABASE_NAME
+        ).render_as_string(hide_password=False)
+        memory_kwargs["chat_memory"] = SQLChatMessageHistory(
+            session_id=os.getenv("SESSION_ID", "default"),
+            connection=history_connection,
+        )
+    except Exception as e:
+        print(f"Warning: persistent chat history unavailable ({e}). Using in-memory history.")
+    memory = PersistentSummaryBufferMemory(**memory_kwargs)
     print("Conversation memory created successfully.")
 
     # 6. Create SQL Agent
+    # The interactive loop captures the SQL from stream events, so neither
+    # verbose tracing nor intermediate-step collection is needed outside DEBUG.
     agent_executor = create_sql_agent(
         llm=llm,
         db=db,
         agent_type="tool-calling",
-        verbose=True,
+        verbose=DEBUG,
         memory=memory,
         handle_parsing_errors=True,
-        return_intermediate_steps=True
+        return_intermediate_steps=DEBUG
     )
     print("\nSQL Agent created successfully. Starting the interactive chatbot now.")
     print("To exit, type 'exit'.")
 
+    response_cache = None
+    if RESPONSE_CACHE_ENABLED:
+        response_cache = ResponseCache(RESPONSE_CACHE_PATH, db_url_to_use)
+        print("Response cache enabled (NL2SQL_CACHE=1).")
+
     # 7. Interactive CLI loop
     while True:
-        user_input = input("\n[User]: ")
+        # input() runs in a worker thread so pending log flushes can make
+        # progress on the event loop while we wait for the user.
+        user_input = await asyncio.to_thread(input, "\n[User]: ")
         if user_input.lower() == "exit":
             print("Exiting the chatbot.")
             break
-        
+
         generated_sql = "N/A"
         final_answer = "An error occurred"
         status = "Error"
+        turn_started = time.monotonic()
+
+        # Deterministic fast path: the input is already SQL, so skip the agent
+        # (and the rate-limited LLM call) and run it directly.
+        if ROUTER.match(user_input):
+            generated_sql = user_input
+            try:
+                observation = await asyncio.to_thread(db.run, user_input)
+                try:
+                    rows = ast.literal_eval(observation) if observation else []
+                    final_answer = "\n".join(
+                        " | ".join(map(str, row)) for row in rows
+                    ) or "(no rows)"
+                except (ValueError, SyntaxError):
+                    final_answer = observation
+                status = "Success-FastPath"
+            except Exception as e:
+                final_answer = f"An error occurred: {e}"
+                status = "Error"
+            print("[Chatbot]:")
+            print(final_answer)
+            log_interaction(
+                user_query=user_input,
+                generated_sql=generated_sql,
+                status=status,
+                final_response=final_answer,
+                latency_ms=int((time.monotonic() - turn_started) * 1000)
+            )
+            continue
+
+        # Snapshot the history before invoke mutates it: the cache key must
+        # describe the conversational state the question was asked in.
+        history_snapshot = str(memory.chat_memory.messages) if response_cache else ""
+        if response_cache is not None:
+            cached = response_cache.get(user_input, history_snapshot)
+            if cached is not None:
+                final_answer, generated_sql = cached
+                print("[Chatbot]:", final_answer)
+                # Keep the conversation memory consistent with the replayed turn.
+                memory.save_context({"input": user_input}, {"output": final_answer})
+                log_interaction(
+                    user_query=user_input,
+                    generated_sql=generated_sql,
+                    status="Success (cached)",
+                    final_response=final_answer,
+                    latency_ms=int((time.monotonic() - turn_started) * 1000)
+                )
+                continue
+
+        # The summary buffer bounds history at summarization time; this
+        # enforces a hard token ceiling on what the agent actually sees this
+        # turn, dropping the oldest turns first. SQLChatMessageHistory exposes
+        # .messages as a getter-only property, so the store is rewritten via
+        # clear()/add_messages() rather than assigned to.
+        current_messages = memory.chat_memory.messages
+        if current_messages:
+            trimmed = trim_messages(
+                current_messages,
+                max_tokens=2000,
+                token_counter=llm.get_num_tokens_from_messages,
+                strategy="last",
+                include_system=True,
+            )
+            if len(trimmed) < len(current_messages):
+                memory.chat_memory.clear()
+                memory.chat_memory.add_messages(trimmed)
 
         try:
-            response = agent_executor.invoke({"input": user_input})
-            final_answer = response.get("output", "Could not find an answer.")
-            print("[Chatbot]:", final_answer)
-
-            if response.get("intermediate_steps"):
-                for step in response["intermediate_steps"]:
-                    if step[0].tool == 'sql_db_query':
-                        generated_sql = step[0].tool_input
-                        break
+            # Stream the response so the user sees tokens at time-to-first-
+            # token instead of waiting for the whole answer to finish.
+            answer_chunks: list[str] = []
+            small_result = None
+            streaming_started = False
+            async for event in agent_executor.astream_events({"input": user_input}, version="v2"):
+                if event["event"] == "on_chat_model_stream":
+                    chunk = event["data"]["chunk"].content
+                    if isinstance(chunk, str) and chunk:
+                        if not streaming_started:
+                            sys.stdout.write("[Chatbot]: ")
+                            streaming_started = True
+                        sys.stdout.write(chunk)
+                        sys.stdout.flush()
+                        answer_chunks.append(chunk)
+                elif event["event"] == "on_tool_end" and event["name"] == "sql_db_query":
+                    tool_input = event["data"].get("input")
+                    generated_sql = tool_input.get("query") if isinstance(tool_input, dict) else tool_input
+                    # Fast path: for a simple count/list question with a tiny
+                    # rowset, emit the rows verbatim and abandon the run here,
+                    # skipping the final summarization LLM call (and its
+                    # rate-limit wait) entirely.
+                    if not streaming_started and SIMPLE_QUERY_RE.search(user_input):
+                        small_result = format_small_result(event["data"].get("output"))
+                        if small_result is not None:
+                            break
+            if streaming_started:
+                print()
+
+            if small_result is not None:
+                final_answer = small_result
+                print("[Chatbot]:", final_answer)
+                # The run was cut short before the chain could record the
+                # turn, so keep the conversation memory consistent manually.
+                memory.save_context({"input": user_input}, {"output": final_answer})
+            else:
+                final_answer = "".join(answer_chunks) or "Could not find an answer."
+                if not streaming_started:
+                    print("[Chatbot]:", final_answer)
             status = "Success"
 
+            if response_cache is not None:
+                response_cache.put(user_input, history_snapshot, final_answer, generated_sql)
+
         except Exception as e:
             final_answer = f"An error occurred: {e}"
             print(final_answer)
@@ -174,8 +817,14 @@ def main():
             user_query=user_input,
             generated_sql=generated_sql,
             status=status,
-            final_response=final_answer
+            final_response=final_answer,
+            latency_ms=int((time.monotonic() - turn_started) * 1000)
         )
 
+    # Make sure every buffered log row reaches the database before exiting.
+    await _drain_logs()
+    if engine is not None:
+        await engine.dispose()
+
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())